@@ -1,12 +1,24 @@
 # app.py
+import csv
+import io
+import itertools
 import json
+import re
+import threading
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
-import pandas as pd
+import marisa_trie
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import streamlit as st
 import gspread
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ----------------------------
 # Config
@@ -15,6 +27,24 @@ PART_CODES_CSV = Path("part_codes.csv")     # must contain column: part_code
 LOCATIONS_SHEET_TAB = "locations"           # Google Sheet tab name
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+# Sheets API retries on quota (429) and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled per attempt
+SHEETS_TIMEOUT = (5, 30)  # (connect, read) seconds per Sheets request
+
+# Sheet columns A:H, in order
+LOCATION_COLUMNS = [
+    "part_code",
+    "row",
+    "rack",
+    "shelf",
+    "bin",
+    "additional_location",
+    "updated_at",
+    "updated_by",
+]
+
 # New optional field
 OPTIONAL_NOTE = "Row, Rack, and Shelf are required. Bin and Additional Location are optional."
 
@@ -25,7 +55,29 @@ OPTIONAL_NOTE = "Row, Rack, and Shelf are required. Bin and Additional Location
 def get_gspread_client():
     sa = json.loads(st.secrets["GCP_SERVICE_ACCOUNT"])
     creds = Credentials.from_service_account_info(sa, scopes=SCOPES)
-    return gspread.authorize(creds)
+
+    # Keep-alive pool shared by all sessions; retry GETs and PUTs on
+    # quota/5xx errors. POSTs are not retried here because append_rows could
+    # add a row twice; the values.batchUpdate POST is retried explicitly in
+    # batch_update_with_retry. raise_on_status=False hands the last response
+    # back to gspread so callers still get an APIError with the API message.
+    session = AuthorizedSession(creds)
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=RETRY_ATTEMPTS,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "PUT"}),
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    client = gspread.Client(creds, session=session)
+    # Saves share one flush lock, so a stuck socket must fail, not hang everyone
+    client.set_timeout(SHEETS_TIMEOUT)
+    return client
 
 
 @st.cache_resource
@@ -37,61 +89,156 @@ def get_locations_ws():
 
 def ensure_locations_header(ws):
     # Updated header to include additional_location (A:H)
-    desired = [
-        "part_code",
-        "row",
-        "rack",
-        "shelf",
-        "bin",
-        "additional_location",
-        "updated_at",
-        "updated_by",
-    ]
+    desired = LOCATION_COLUMNS
     header = ws.row_values(1)
     if header != desired:
         ws.clear()
         ws.append_row(desired)
 
 
-@st.cache_data(ttl=60)
-def load_locations_index():
+@st.cache_resource
+def get_verified_ws():
     """
-    Build a dict {part_code: row_number} by reading only the first column.
-    Cached for 60 seconds to reduce API calls.
+    Return the locations worksheet after checking its header once per process,
+    so reads and writes don't pay an extra row_values(1) round-trip each time.
     """
     ws = get_locations_ws()
     ensure_locations_header(ws)
+    return ws
 
-    col = ws.col_values(1)  # includes header
+
+@st.cache_resource(ttl=60)
+def load_locations_index():
+    """
+    Build a dict {part_code: (row_number, record)} from a single get_all_values()
+    call, so lookups and record fetches share one API request.
+    Cached for 60 seconds to reduce API calls. The dict is shared and mutable:
+    upsert_location_to_sheet writes saved rows straight into it.
+    """
+    ws = get_verified_ws()
+
+    values = ws.get_all_values()  # includes header
     idx = {}
-    for i, code in enumerate(col[1:], start=2):  # row 1 is header
-        code = (code or "").strip()
+    for i, row in enumerate(values[1:], start=2):  # row 1 is header
+        code = (row[0] if row else "").strip()
         if code:
-            idx[code] = i
+            row = row + [""] * (len(LOCATION_COLUMNS) - len(row))  # pad to A:H
+            idx[code] = (i, dict(zip(LOCATION_COLUMNS, row)))
     return idx
 
 
 def fetch_location_from_sheet(part_code: str):
-    ws = get_locations_ws()
-    ensure_locations_header(ws)
+    hit = load_locations_index().get(part_code)
+    if not hit:
+        return None
+    return dict(hit[1])
+
+
+@st.cache_resource
+def get_write_queue():
+    """
+    Process-wide queue of pending sheet writes, shared by all sessions.
+    Whoever holds flush_lock sends everything queued so far in one batch.
+    """
+    return {"pending": [], "lock": threading.Lock(), "flush_lock": threading.Lock()}
+
+
+def batch_update_with_retry(ws, body):
+    """
+    values.batchUpdate only sets fixed ranges, so resending it can't
+    duplicate rows; retry it on quota/5xx errors like the session does GETs.
+    """
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        try:
+            return ws.spreadsheet.values_batch_update(body=body)
+        except gspread.exceptions.APIError as e:
+            status = getattr(e.response, "status_code", None)
+            if status not in RETRY_STATUSES or attempt == RETRY_ATTEMPTS:
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
 
+def write_through_index(idx, entries):
+    """
+    Put just-written rows into the cached index so the next read is served
+    from memory. If the TTL evicted idx mid-flush, the reloaded index may
+    predate these writes (and miss a just-appended code), so merge into the
+    live one too.
+    """
+    idx.update(entries)
+    current = load_locations_index()
+    if current is not idx:
+        current.update(entries)
+
+
+def flush_pending_writes(queue):
+    # Resolve these before draining: a cache miss here can raise (including
+    # Streamlit's BaseException-based Stop/Rerun), and nothing must be off
+    # the queue when it does.
+    ws = get_verified_ws()
     idx = load_locations_index()
-    rownum = idx.get(part_code)
-    if not rownum:
-        return None
 
-    row = ws.row_values(rownum)
-    row += [""] * (8 - len(row))  # pad to A:H
-    return {
-        "part_code": row[0],
-        "row": row[1],
-        "rack": row[2],
-        "shelf": row[3],
-        "bin": row[4],
-        "additional_location": row[5],
-        "updated_at": row[6],
-        "updated_by": row[7],
-    }
+    with queue["lock"]:
+        batch, queue["pending"] = queue["pending"], []
+    if not batch:
+        return
+
+    sent = set()  # part codes whose latest values reached the sheet
+    error = None
+    try:
+        # One timestamp for the whole batch, taken when it is actually sent
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        latest = {}
+        for w in batch:  # last write per code wins
+            values = list(w["values"])
+            values[LOCATION_COLUMNS.index("updated_at")] = now
+            latest[w["part_code"]] = values
+        updates, appends = [], []
+        for code, values in latest.items():
+            hit = idx.get(code)
+            if hit:
+                updates.append((code, hit[0], values))
+            else:
+                appends.append((code, values))
+
+        if updates:
+            # Update existing rows A:H in a single request
+            batch_update_with_retry(
+                ws,
+                body={
+                    "valueInputOption": "RAW",
+                    "data": [
+                        {"range": f"{LOCATIONS_SHEET_TAB}!A{rownum}:H{rownum}", "values": [values]}
+                        for _, rownum, values in updates
+                    ],
+                },
+            )
+            sent.update(code for code, _, _ in updates)
+            write_through_index(idx, {
+                code: (rownum, dict(zip(LOCATION_COLUMNS, values)))
+                for code, rownum, values in updates
+            })
+
+        if appends:
+            resp = ws.append_rows([values for _, values in appends])
+            sent.update(code for code, _ in appends)
+            # e.g. "locations!A42:H44" -> 42
+            m = re.search(r"![A-Z]+(\d+)", (resp or {}).get("updates", {}).get("updatedRange", ""))
+            if m:
+                write_through_index(idx, {
+                    code: (int(m.group(1)) + offset, dict(zip(LOCATION_COLUMNS, values)))
+                    for offset, (code, values) in enumerate(appends)
+                })
+            else:
+                load_locations_index.clear()
+    except Exception as e:
+        error = e
+    finally:
+        # Anything not confirmed sent is failed, whatever interrupted the flush
+        for w in batch:
+            if w["part_code"] not in sent:
+                w["error"] = error or RuntimeError("Save was interrupted before it reached the sheet.")
+            w["done"].set()
 
 
 def upsert_location_to_sheet(
@@ -103,12 +250,6 @@ def upsert_location_to_sheet(
     additional_location: str | None,
     updated_by: str = "",
 ):
-    ws = get_locations_ws()
-    ensure_locations_header(ws)
-
-    idx = load_locations_index()
-    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
-
     values = [
         part_code,
         row_loc,
@@ -116,42 +257,85 @@ def upsert_location_to_sheet(
         shelf,
         bin_val or "",
         additional_location or "",
-        now,
+        None,  # updated_at, stamped per batch by flush_pending_writes
         updated_by or "",
     ]
 
-    rownum = idx.get(part_code)
-    if rownum:
-        # Update existing row A:H
-        ws.update(f"A{rownum}:H{rownum}", [values])
-    else:
-        ws.append_row(values)
+    write = {"part_code": part_code, "values": values, "done": threading.Event(), "error": None}
+    queue = get_write_queue()
+    with queue["lock"]:
+        queue["pending"].append(write)
+
+    # Saves that queue up while another session is flushing go out together
+    # in the next batch; this call returns only once its own write is sent.
+    with queue["flush_lock"]:
+        if not write["done"].is_set():
+            try:
+                flush_pending_writes(queue)
+            except BaseException:
+                # If the flush failed before taking our write, don't leave it
+                # queued to be sent after we've already reported an error
+                with queue["lock"]:
+                    queue["pending"] = [w for w in queue["pending"] if w is not write]
+                raise
+
+    if write["error"]:
+        raise write["error"]
+
+
+def export_locations_csv() -> bytes | None:
+    """
+    Fetch A:H with one values.get call and encode it as CSV.
+    Returns None when only the header row exists.
+    """
+    ws = get_verified_ws()
+    resp = ws.spreadsheet.values_get(f"{LOCATIONS_SHEET_TAB}!A:H", params={"majorDimension": "ROWS"})
+    rows = resp.get("values", [])[1:]  # row 1 is header
+    if not rows:
+        return None
 
-    load_locations_index.clear()
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(LOCATION_COLUMNS)
+    for r in rows:
+        # The API drops trailing empty cells, so pad short rows to A:H
+        writer.writerow(r + [""] * (len(LOCATION_COLUMNS) - len(r)))
+    return buf.getvalue().encode("utf-8")
 
 
 # ----------------------------
 # Part codes load (CSV)
 # ----------------------------
-@st.cache_data(show_spinner=False)
-def load_part_codes(csv_path: Path) -> pd.Series:
-    df = pd.read_csv(csv_path, dtype={"part_code": "string"})
-    if "part_code" not in df.columns:
+def read_part_codes_csv(csv_path: Path) -> list[str]:
+    table = pacsv.read_csv(
+        csv_path,
+        convert_options=pacsv.ConvertOptions(column_types={"part_code": pa.string()}),
+    )
+    if "part_code" not in table.column_names:
         raise ValueError("part_codes.csv must have a column named 'part_code'")
-    codes = df["part_code"].dropna().astype(str).str.strip()
-    codes = codes[codes != ""].drop_duplicates()
-    return codes
+    codes = pc.utf8_trim_whitespace(table["part_code"])
+    # Comparison with "" is null for null cells and filter() drops nulls, so
+    # this one mask removes both. Duplicates are left for the trie to collapse.
+    return pc.filter(codes, pc.not_equal(codes, "")).to_pylist()
 
 
-def exact_match_in_series(codes: pd.Series, q: str) -> bool:
-    return (codes == q).any()
+@st.cache_resource(show_spinner=False)
+def load_part_codes(csv_path: Path) -> marisa_trie.Trie:
+    """
+    Return the master list as a static trie, used for both exact matches and
+    prefix lookups. The trie de-duplicates keys, and LABEL_ORDER keeps them
+    sorted, so the loader skips both steps.
+    Cached as a resource so every rerun reuses the same trie.
+    """
+    # LABEL_ORDER keeps iterkeys(prefix) lexicographic; the default
+    # WEIGHT_ORDER would return suggestions in the trie's internal order.
+    return marisa_trie.Trie(read_part_codes_csv(csv_path), order=marisa_trie.LABEL_ORDER)
 
 
-def prefix_suggestions(codes: pd.Series, prefix: str, limit: int = 50) -> list[str]:
+def prefix_suggestions(codes: marisa_trie.Trie, prefix: str, limit: int = 50) -> list[str]:
     if not prefix:
         return []
-    matches = codes[codes.str.startswith(prefix, na=False)].head(limit)
-    return matches.tolist()
+    return list(itertools.islice(codes.iterkeys(prefix), limit))
 
 
 # ----------------------------
@@ -172,8 +356,7 @@ if "GCP_SERVICE_ACCOUNT" not in st.secrets or "SHEET_ID" not in st.secrets:
 
 # Ensure sheet is accessible
 try:
-    ws = get_locations_ws()
-    ensure_locations_header(ws)
+    ws = get_verified_ws()
 except Exception as e:
     st.error(
         "Could not access Google Sheet tab 'locations'.\n\n"
@@ -210,7 +393,7 @@ selected_part_code = None
 if query:
     q = query.strip()
 
-    if q and exact_match_in_series(codes, q):
+    if q and q in codes:
         selected_part_code = q
         st.success("Exact match found in master list.")
     else:
@@ -293,16 +476,13 @@ if selected_part_code:
 st.divider()
 
 if st.button("Download all saved mappings as CSV"):
-    ws = get_locations_ws()
-    ensure_locations_header(ws)
-    values = ws.get_all_values()
-    if len(values) <= 1:
+    csv_bytes = export_locations_csv()
+    if csv_bytes is None:
         st.info("No mappings saved yet.")
     else:
-        df = pd.DataFrame(values[1:], columns=values[0])
         st.download_button(
             "Click to download",
-            data=df.to_csv(index=False).encode("utf-8"),
+            data=csv_bytes,
             file_name="inventory_locations.csv",
             mime="text/csv",
         )